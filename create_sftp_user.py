@@ -6,12 +6,9 @@ Creates user account, home directory, and upload folder with proper permissions
 """
 
 import os
+import re
 import sys
 import subprocess
-import getpass
-import pwd
-import grp
-from pathlib import Path
 
 # ============================================================================
 # SETTINGS - MODIFY THESE VARIABLES AS NEEDED
@@ -36,6 +33,45 @@ SSH_CONFIG_FILE = "/etc/ssh/sshd_config.d/some_custom.conf"
 # END OF SETTINGS
 # ============================================================================
 
+# Valid username: letters, numbers, hyphens, underscores; must start with a
+# letter or number; at most 32 characters
+USERNAME_RE = re.compile(r'^[A-Za-z0-9][A-Za-z0-9_-]{0,31}$')
+
+# Detect init system once (this directory only exists when booted with systemd)
+IS_SYSTEMD = os.path.exists('/run/systemd/system')
+
+# Usual absolute paths of system commands (see resolve_command)
+GROUPADD_CMD = '/usr/sbin/groupadd'
+USERADD_CMD = '/usr/sbin/useradd'
+CHPASSWD_CMD = '/usr/sbin/chpasswd'
+SYSTEMCTL_CMD = '/bin/systemctl'
+SERVICE_CMD = '/usr/sbin/service'
+
+# Where systemd unit files and SysV init scripts for the SSH server live
+SYSTEMD_UNIT_DIRS = ('/etc/systemd/system', '/usr/lib/systemd/system', '/lib/systemd/system')
+INIT_SCRIPT_DIR = '/etc/init.d'
+
+# First AllowUsers directive in the SSH config (whole line, without newline)
+ALLOW_USERS_RE = re.compile(r'^[ \t]*AllowUsers\b[^\n]*', re.MULTILINE)
+
+def resolve_command(path):
+    """Return path if it is executable, otherwise the bare name for a PATH search"""
+    if os.access(path, os.X_OK):
+        return path
+    return os.path.basename(path)
+
+def detect_ssh_service_name():
+    """Return SSH server service name: 'ssh' on Debian/Ubuntu, 'sshd' elsewhere"""
+    if IS_SYSTEMD:
+        # sshd.service is only an alias on Debian/Ubuntu and may not exist
+        for unit_dir in SYSTEMD_UNIT_DIRS:
+            if os.path.exists(f"{unit_dir}/ssh.service"):
+                return 'ssh'
+        return 'sshd'
+    if os.path.exists(f"{INIT_SCRIPT_DIR}/ssh"):
+        return 'ssh'
+    return 'sshd'
+
 def check_root_privileges():
     """Check if script is run with root privileges"""
     if os.geteuid() != 0:
@@ -45,6 +81,8 @@ def check_root_privileges():
 
 def get_user_input():
     """Get username and password from user input"""
+    import getpass
+    
     print("=" * 60)
     print("SFTP USER CREATION SCRIPT")
     print("=" * 60)
@@ -53,13 +91,11 @@ def get_user_input():
     while True:
         username = input("Enter username for new SFTP user: ").strip()
         if username:
-            # Allow letters, numbers, hyphens, and underscores
-            # Must start with a letter or number
-            if username.replace('-', '').replace('_', '').isalnum() and username[0].isalnum():
+            if USERNAME_RE.match(username):
                 break
             else:
                 print("ERROR: Username must contain only letters, numbers, hyphens (-), and underscores (_)")
-                print("       and must start with a letter or number")
+                print("       must start with a letter or number, and be at most 32 characters")
         else:
             print("ERROR: Username cannot be empty")
     
@@ -79,6 +115,8 @@ def get_user_input():
 
 def check_user_exists(username):
     """Check if user already exists"""
+    import pwd
+    
     try:
         pwd.getpwnam(username)
         return True
@@ -87,6 +125,8 @@ def check_user_exists(username):
 
 def check_group_exists(groupname):
     """Check if group exists, create if it doesn't"""
+    import grp
+    
     try:
         grp.getgrnam(groupname)
         return True
@@ -95,7 +135,7 @@ def check_group_exists(groupname):
         create_group = input(f"Create group '{groupname}'? (y/n): ").lower().strip()
         if create_group == 'y':
             try:
-                subprocess.run(['groupadd', groupname], check=True, capture_output=True)
+                subprocess.run([resolve_command(GROUPADD_CMD), groupname], check=True, capture_output=True)
                 print(f"Group '{groupname}' created successfully")
                 return True
             except subprocess.CalledProcessError as e:
@@ -104,14 +144,12 @@ def check_group_exists(groupname):
         else:
             return False
 
-def create_user(username, password):
+def create_user(username, password, home_dir):
     """Create new user account"""
     try:
         # Create user with specific home directory and shell
-        home_dir = os.path.join(SFTP_BASE_DIR, username)
-        
         cmd = [
-            'useradd',
+            resolve_command(USERADD_CMD),
             '--home-dir', home_dir,
             '--shell', DEFAULT_SHELL,
             '--gid', SFTP_GROUP,
@@ -125,8 +163,8 @@ def create_user(username, password):
         
         # Set password
         print(f"Setting password for user '{username}'...")
-        password_cmd = f"echo '{username}:{password}' | chpasswd"
-        subprocess.run(password_cmd, shell=True, check=True)
+        subprocess.run([resolve_command(CHPASSWD_CMD)], input=f"{username}:{password}\n",
+                       check=True, capture_output=True, text=True)
         print(f"Password set successfully")
         
         return True
@@ -140,42 +178,44 @@ def create_user(username, password):
         print(f"ERROR: Unexpected error creating user: {e}")
         return False
 
-def create_directories(username):
+def create_directories(username, home_dir, upload_dir, uid, gid):
     """Create user directories with proper permissions"""
     try:
-        home_dir = os.path.join(SFTP_BASE_DIR, username)
-        upload_dir = os.path.join(home_dir, UPLOAD_DIR_NAME)
-        
         print(f"Creating directories for user '{username}'...")
         
-        # Create home directory if it doesn't exist
-        if not os.path.exists(home_dir):
-            os.makedirs(home_dir, mode=0o755)
-            print(f"Created home directory: {home_dir}")
-        
-        # Create upload directory
-        if not os.path.exists(upload_dir):
-            os.makedirs(upload_dir, mode=0o755)
-            print(f"Created upload directory: {upload_dir}")
+        # Fix the umask so newly created parents like SFTP_BASE_DIR get 755
+        # (not 0 - they would become 777)
+        old_umask = os.umask(0o022)
+        try:
+            # Create home directory (no-op if it already exists)
+            os.makedirs(home_dir, mode=0o755, exist_ok=True)
+            print(f"Home directory: {home_dir}")
+            
+            # Create upload directory
+            os.makedirs(upload_dir, mode=0o755, exist_ok=True)
+            print(f"Upload directory: {upload_dir}")
+        finally:
+            os.umask(old_umask)
         
         # Set ownership: home directory to root, upload directory to user:sftpusers
         print(f"Setting ownership...")
         print(f"  Home directory: root:root")
-        subprocess.run(['chown', 'root:root', home_dir], check=True)
+        os.chown(home_dir, 0, 0)
         print(f"  Upload directory: {username}:{SFTP_GROUP}")
-        subprocess.run(['chown', f'{username}:{SFTP_GROUP}', upload_dir], check=True)
+        os.chown(upload_dir, uid, gid)
         
-        # Set proper permissions
+        # Set proper permissions (existing directories, e.g. a home created
+        # by useradd with CREATE_HOME, keep their old mode otherwise)
         print("Setting directory permissions...")
         # Home directory: 755 (root can read/write, others can read/execute)
-        subprocess.run(['chmod', '755', home_dir], check=True)
+        os.chmod(home_dir, 0o755)
         # Upload directory: 755 (user can read/write, others can read/execute)
-        subprocess.run(['chmod', '755', upload_dir], check=True)
+        os.chmod(upload_dir, 0o755)
         
         print(f"Directories created and configured successfully")
         return True
         
-    except subprocess.CalledProcessError as e:
+    except OSError as e:
         print(f"ERROR: Failed to set permissions: {e}")
         return False
     except Exception as e:
@@ -197,110 +237,131 @@ def configure_ssh_access(username):
         return False
 
 def update_ssh_config(username):
-    """Update SSH configuration to allow the new user"""
+    """Update SSH configuration to allow the new user
+    
+    Returns (success, changed) - changed is True only if the file was rewritten
+    """
     try:
         print(f"Updating SSH configuration for user '{username}'...")
         
-        # Check if file exists
-        if not os.path.exists(SSH_CONFIG_FILE):
+        # Open once for reading and writing (fails if file doesn't exist)
+        try:
+            f = open(SSH_CONFIG_FILE, 'r+')
+        except FileNotFoundError:
             print(f"WARNING: SSH config file {SSH_CONFIG_FILE} not found")
             print("You may need to create it manually or add user to main sshd_config")
-            return False
+            return False, False
         
-        # Read current configuration
-        with open(SSH_CONFIG_FILE, 'r') as f:
-            lines = f.readlines()
-        
-        # Find AllowUsers line
-        allow_users_line = None
-        for i, line in enumerate(lines):
-            if line.strip().startswith('AllowUsers'):
-                allow_users_line = i
-                break
-        
-        if allow_users_line is not None:
-            # Update existing AllowUsers line
-            current_line = lines[allow_users_line].strip()
-            print(f"Found existing AllowUsers line: '{current_line}'")
+        with f:
+            # Read current configuration
+            data = f.read()
             
-            if username not in current_line:
-                # Add username to existing AllowUsers
-                old_line = current_line
-                if current_line.endswith('\\'):
-                    # Multi-line format - add to current line
-                    lines[allow_users_line] = current_line + ' ' + username + '\n'
+            modified = False
+            
+            # Find AllowUsers line
+            match = ALLOW_USERS_RE.search(data)
+            
+            if match:
+                # Update existing AllowUsers line
+                current_line = match.group().strip()
+                print(f"Found existing AllowUsers line: '{current_line}'")
+                
+                if username not in current_line.partition('#')[0].split()[1:]:
+                    # Add username after the last user on the existing AllowUsers line
+                    updated = add_allowed_user(match.group(), username)
+                    data = data[:match.start()] + updated + data[match.end():]
+                    modified = True
+                    new_line = updated.strip()
+                    print(f"Updated AllowUsers line:")
+                    print(f"  OLD: '{current_line}'")
+                    print(f"  NEW: '{new_line}'")
+                    print(f"Added '{username}' to existing AllowUsers line")
                 else:
-                    # Single line format - add to current line
-                    lines[allow_users_line] = current_line + ' ' + username + '\n'
-                new_line = lines[allow_users_line].strip()
-                print(f"Updated AllowUsers line:")
-                print(f"  OLD: '{old_line}'")
-                print(f"  NEW: '{new_line}'")
-                print(f"Added '{username}' to existing AllowUsers line")
+                    print(f"User '{username}' already in AllowUsers")
             else:
-                print(f"User '{username}' already in AllowUsers")
-        else:
-            # Create new AllowUsers line
-            lines.append(f'AllowUsers {username}\n')
-            print(f"Created new AllowUsers line with '{username}'")
-        
-        # Write updated configuration
-        with open(SSH_CONFIG_FILE, 'w') as f:
-            f.writelines(lines)
+                # Create new AllowUsers line
+                if data and not data.endswith('\n'):
+                    data += '\n'
+                new_line = f'AllowUsers {username}'
+                data += new_line + '\n'
+                modified = True
+                print(f"Created new AllowUsers line with '{username}'")
+            
+            # Nothing to write if the user was already allowed
+            if not modified:
+                return True, False
+            
+            # Write updated configuration in place
+            f.seek(0)
+            f.truncate()
+            f.write(data)
         
         # Verify the update
         print(f"SSH configuration updated successfully")
         print(f"File: {SSH_CONFIG_FILE}")
         
-        # Show final result
-        with open(SSH_CONFIG_FILE, 'r') as f:
-            final_lines = f.readlines()
-            for line in final_lines:
-                if line.strip().startswith('AllowUsers'):
-                    print(f"Final AllowUsers line: '{line.strip()}'")
-                    break
+        # Show final result (from memory, no need to re-read the file)
+        print(f"Final AllowUsers line: '{new_line}'")
         
-        return True
+        return True, True
         
     except Exception as e:
         print(f"ERROR: Failed to update SSH configuration: {e}")
-        return False
+        return False, False
 
-def restart_ssh_service():
-    """Restart SSH service to apply configuration changes"""
+def add_allowed_user(line, username):
+    """Add username to an AllowUsers line, keeping any trailing comment last
+    
+    >>> add_allowed_user('  AllowUsers alice  ', 'bob')
+    '  AllowUsers alice bob'
+    >>> add_allowed_user('AllowUsers alice  # admins', 'bob')
+    'AllowUsers alice bob  # admins'
+    """
+    directive, sep, comment = line.partition('#')
+    code = directive.rstrip()
+    if not sep:
+        return code + ' ' + username
+    return code + ' ' + username + directive[len(code):] + sep + comment
+
+def reload_ssh_service():
+    """Reload SSH service to apply configuration changes
+    
+    A reload re-reads the configuration without dropping existing sessions;
+    a stopped service is started instead, as the old restart did
+    """
+    service_name = detect_ssh_service_name()
+    if IS_SYSTEMD:
+        # reload-or-restart also starts the unit if it is inactive
+        cmds = [[resolve_command(SYSTEMCTL_CMD), 'reload-or-restart', service_name]]
+        tool = 'systemctl'
+    else:
+        # SysV reload fails if the service is stopped, so fall back to restart
+        service_cmd = resolve_command(SERVICE_CMD)
+        cmds = [[service_cmd, service_name, 'reload'],
+                [service_cmd, service_name, 'restart']]
+        tool = 'service'
+    
     try:
-        print("Restarting SSH service...")
-        
-        # Try systemctl first (modern systems)
-        try:
-            result = subprocess.run(['systemctl', 'restart', 'sshd'], 
-                                  check=True, capture_output=True, text=True)
-            print("SSH service restarted successfully (systemctl)")
-            return True
-        except subprocess.CalledProcessError:
-            # Try service command (older systems)
+        print("Reloading SSH service...")
+        for cmd in cmds:
             try:
-                result = subprocess.run(['service', 'ssh', 'restart'], 
-                                      check=True, capture_output=True, text=True)
-                print("SSH service restarted successfully (service)")
+                subprocess.run(cmd, check=True, capture_output=True, text=True)
+                print(f"SSH service reloaded successfully ({tool})")
                 return True
             except subprocess.CalledProcessError:
-                print("WARNING: Could not restart SSH service automatically")
-                print("Please restart SSH service manually:")
-                print("  sudo systemctl restart sshd")
-                print("  or")
-                print("  sudo service ssh restart")
-                return False
-                
+                continue
+        
+        print("WARNING: Could not reload SSH service automatically")
+        print("Please reload SSH service manually:")
+        print(f"  sudo {' '.join(cmds[0])}")
+        return False
+        
     except Exception as e:
-        print(f"ERROR: Failed to restart SSH service: {e}")
+        print(f"ERROR: Failed to reload SSH service: {e}")
         return False
 
-def display_summary(username):
+def display_summary(username, home_dir, upload_dir, ssh_config_changed, ssh_reloaded):
     """Display summary of created user"""
-    home_dir = os.path.join(SFTP_BASE_DIR, username)
-    upload_dir = os.path.join(home_dir, UPLOAD_DIR_NAME)
-    
     print("\n" + "=" * 60)
     print("USER CREATION SUMMARY")
     print("=" * 60)
@@ -333,8 +394,14 @@ def display_summary(username):
     print(f"• User can browse home directory but upload only to upload/ subdirectory")
     print(f"• No SSH key authentication configured")
     print(f"• No system files (.bashrc, .profile, etc.) created")
-    print(f"• SSH configuration updated: user added to AllowUsers")
-    print(f"• SSH service restarted to apply changes")
+    if ssh_config_changed:
+        print(f"• SSH configuration updated: user added to AllowUsers")
+        if ssh_reloaded:
+            print(f"• SSH service reloaded to apply changes")
+        else:
+            print(f"• SSH service NOT reloaded - reload it manually to apply changes")
+    else:
+        print(f"• SSH configuration not changed, SSH service not reloaded")
 
 def main():
     """Main function"""
@@ -342,9 +409,16 @@ def main():
         # Check if running as root
         check_root_privileges()
         
+        # Like the other helpers, load pwd only once the root check has passed
+        import pwd
+        
         # Get user input
         username, password = get_user_input()
         
+        # User paths (username is validated, so a plain join is safe)
+        home_dir = f"{SFTP_BASE_DIR}/{username}"
+        upload_dir = f"{home_dir}/{UPLOAD_DIR_NAME}"
+        
         # Check if user already exists
         if check_user_exists(username):
             print(f"ERROR: User '{username}' already exists")
@@ -356,12 +430,21 @@ def main():
             sys.exit(1)
         
         # Create user account
-        if not create_user(username, password):
+        if not create_user(username, password, home_dir):
             print("ERROR: Failed to create user account")
             sys.exit(1)
         
+        # Look up the new account once; its primary group is SFTP_GROUP
+        try:
+            user_info = pwd.getpwnam(username)
+        except KeyError:
+            print(f"ERROR: Created user '{username}' not found in the user database")
+            print("       (name service cache may be stale); directories were not created")
+            sys.exit(1)
+        
         # Create directories
-        if not create_directories(username):
+        if not create_directories(username, home_dir, upload_dir,
+                                  user_info.pw_uid, user_info.pw_gid):
             print("ERROR: Failed to create directories")
             sys.exit(1)
         
@@ -370,15 +453,19 @@ def main():
             print("WARNING: Failed to configure SSH access")
         
         # Update SSH config
-        if not update_ssh_config(username):
+        ssh_config_ok, ssh_config_changed = update_ssh_config(username)
+        if not ssh_config_ok:
             print("WARNING: Failed to update SSH configuration")
         
-        # Restart SSH service
-        if not restart_ssh_service():
-            print("WARNING: Failed to restart SSH service")
+        # Reload SSH service only if the configuration actually changed
+        ssh_reloaded = False
+        if ssh_config_ok and ssh_config_changed:
+            ssh_reloaded = reload_ssh_service()
+            if not ssh_reloaded:
+                print("WARNING: Failed to reload SSH service")
         
         # Display summary
-        display_summary(username)
+        display_summary(username, home_dir, upload_dir, ssh_config_changed, ssh_reloaded)
         
         print("\n" + "=" * 60)
         print("USER CREATION COMPLETED SUCCESSFULLY!")